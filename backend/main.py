@@ -1,40 +1,51 @@
-from fastapi import FastAPI, Request, Depends, HTTPException, Header
+from fastapi import FastAPI, Request, Depends, HTTPException, Header, BackgroundTasks, Query
 from starlette.middleware.sessions import SessionMiddleware
-from fastapi.responses import RedirectResponse, JSONResponse
+from fastapi.responses import RedirectResponse, ORJSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from dotenv import load_dotenv
 from authlib.integrations.starlette_client import OAuth
 from typing import List, Optional
 from openai import OpenAI
-import random, os, json, hashlib
+import random, os, hashlib, threading, time, uuid
+import anyio.to_thread
+import orjson
 from datetime import datetime
-from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
+from itsdangerous import BadSignature, SignatureExpired
+from cachetools import TTLCache
+from sqlalchemy import func, insert, or_, select
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
 
 
-from .models import User, TriviaLog, Question, UserQuestion
+from .models import User, TriviaLog, Question, UserQuestion, assigned_to
 from .database import SessionLocal, engine, Base
+from .signing import TokenSigner
+from .migrations import migrate_unique_assignments
 from pydantic import BaseModel
-import os, pprint
+import logging
 
 
 # Load environment variables
 load_dotenv()
 
-print("=== All Environment Variables ===")
-for k, v in os.environ.items():
-    print(f"{k}={v}")
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
+logger = logging.getLogger(__name__)
 
 FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:8501")
 BACKEND_URL = os.getenv("BACKEND_URL", "http://localhost:8000")
 # Create all tables defined in models.py
-print("Tables to create:", Base.metadata.tables.keys())
+logger.info("Tables to create: %s", list(Base.metadata.tables))
 Base.metadata.create_all(bind=engine)
+# create_all skips existing tables, so older databases get the unique assignment index here
+migrate_unique_assignments(engine)
 
 # Set the key globally
 api_key = os.getenv("OPENAI_API_KEY")
 client = OpenAI(api_key=api_key)
 testing = False
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 
 app.add_middleware(SessionMiddleware, os.getenv("SECRET_KEY"))
@@ -48,7 +59,10 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
-print("CORS middleware added with frontend URL:", FRONTEND_URL)
+logger.info("CORS middleware added with frontend URL: %s", FRONTEND_URL)
+
+# Question payloads are repetitive JSON text; compress anything non-trivial
+app.add_middleware(GZipMiddleware, minimum_size=1000)
 # Google OAuth Setup
 oauth = OAuth()
 oauth.register(
@@ -59,26 +73,49 @@ oauth.register(
     client_kwargs={'scope': 'openid email profile'},
 )
 
-# itsdangerous setup
+# Token signing setup
 SECRET_KEY = os.getenv("SECRET_KEY")
 TOKEN_EXPIRY_SECONDS = 3600  # 1 hour
-serializer = URLSafeTimedSerializer(SECRET_KEY)
+serializer = TokenSigner(SECRET_KEY)
+
+# Recently verified tokens, keyed by a digest so raw tokens aren't kept in memory.
+# An entry can outlive its token's expiry by at most TOKEN_CACHE_SECONDS.
+TOKEN_CACHE_SECONDS = min(60, TOKEN_EXPIRY_SECONDS)
+token_cache = TTLCache(maxsize=4096, ttl=TOKEN_CACHE_SECONDS)
+token_cache_lock = threading.Lock()
 
 def generate_token(user_info):
     return serializer.dumps(user_info)
 
 def verify_token(token):
-    print(f"[VERIFY TOKEN] Verifying token: {token}")
+    cache_key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+    with token_cache_lock:
+        user_info = token_cache.get(cache_key)
+    if user_info is not None:
+        return user_info
     try:
         user_info = serializer.loads(token, max_age=TOKEN_EXPIRY_SECONDS)
-        print(f"[VERIFY TOKEN] Token valid. User info: {user_info}")
+        logger.debug("[VERIFY TOKEN] Token valid for %s", user_info.get("email"))
+        with token_cache_lock:
+            token_cache[cache_key] = user_info
         return user_info
     except SignatureExpired:
-        print("[VERIFY TOKEN] Token expired.")
+        logger.info("[VERIFY TOKEN] Token expired.")
         raise HTTPException(status_code=401, detail="Token expired")
     except BadSignature:
-        print("[VERIFY TOKEN] Invalid token signature.")
+        logger.info("[VERIFY TOKEN] Invalid token signature.")
+        raise HTTPException(status_code=401, detail="Invalid token")
+
+def require_user(authorization: Optional[str] = Header(None)):
+    """Dependency resolving the bearer token to the user's info, or raising 401."""
+    if not authorization or not authorization.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="Authentication required")
+    
+    token = authorization.split(" ", 1)[1]
+    user_info = verify_token(token)
+    if not user_info:
         raise HTTPException(status_code=401, detail="Invalid token")
+    return user_info
 
 
 
@@ -135,39 +172,34 @@ def read_root():
 @app.get("/login")
 async def login(request: Request):
     redirect_uri = request.url_for("auth_callback")
-    print(f"[LOGIN] Redirecting to Google OAuth. Redirect URI: {redirect_uri}")
+    logger.debug("[LOGIN] Redirecting to Google OAuth. Redirect URI: %s", redirect_uri)
     return await oauth.google.authorize_redirect(request, redirect_uri)
 
 
 
 # Function to check if user is authenticated (token-based)
 @app.get("/me")
-async def get_current_user(authorization: Optional[str] = Header(None)):
-    print(f"[/me] Authorization header: {authorization}")
-    if not authorization or not authorization.startswith("Bearer "):
-        print("[/me] Missing or invalid token format.")
-        raise HTTPException(status_code=401, detail="Missing token")
-    token = authorization.split(" ", 1)[1]
-    try:
-        user_info = verify_token(token)
-        print(f"[/me] Token verified. User info: {user_info}")
-        return JSONResponse(content=user_info)
-    except Exception as e:
-        print(f"[/me] Token verification failed: {str(e)}")
-        raise
+async def get_current_user(
+    if_none_match: Optional[str] = Header(None),
+    user_info: dict = Depends(require_user)
+):
+    # ETag lets clients revalidate with If-None-Match and get an empty 304
+    body = orjson.dumps(user_info, option=orjson.OPT_SORT_KEYS)
+    etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+    if if_none_match == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    return ORJSONResponse(content=user_info, headers={"ETag": etag})
 
 @app.get("/auth/callback")
 async def auth_callback(request: Request):
     try:
-        print("[AUTH CALLBACK] Starting Google OAuth callback.")
+        logger.debug("[AUTH CALLBACK] Starting Google OAuth callback.")
         token = await oauth.google.authorize_access_token(request)
-        print(f"[AUTH CALLBACK] Received token: {token}")
         if "id_token" not in token:
-            print("[AUTH CALLBACK] Missing id_token in response.")
+            logger.warning("[AUTH CALLBACK] Missing id_token in response.")
             raise HTTPException(status_code=400, detail="Missing id_token in response")
         user_info = await oauth.google.get("https://openidconnect.googleapis.com/v1/userinfo", token=token)
         user_info = user_info.json()
-        print(f"[AUTH CALLBACK] User info: {user_info}")
 
         db = SessionLocal()
         if not db.query(User).filter(User.email == user_info["email"]).first():
@@ -177,30 +209,24 @@ async def auth_callback(request: Request):
                 picture=user_info["picture"]
             ))
             db.commit()
-            print(f"[AUTH CALLBACK] New user added: {user_info['email']}")
+            logger.info("[AUTH CALLBACK] New user added: %s", user_info["email"])
         else:
-            print(f"[AUTH CALLBACK] User already exists: {user_info['email']}")
+            logger.debug("[AUTH CALLBACK] User already exists: %s", user_info["email"])
         db.close()
 
         # Generate signed token
         signed_token = generate_token(user_info)
-        print(f"[AUTH CALLBACK] Generated signed token: {signed_token}")
         # Redirect with token in query param
         redirect_url = f"{FRONTEND_URL}/?token={signed_token}"
-        print(f"[AUTH CALLBACK] Redirecting to: {redirect_url}")
         return RedirectResponse(url=redirect_url)
     except Exception as e:
-        print(f"[AUTH CALLBACK] Error: {str(e)}")
+        logger.exception("[AUTH CALLBACK] Error: %s", e)
         raise HTTPException(status_code=500, detail="Authentication failed")
 
 
 
 @app.get("/protected")
-def protected(authorization: Optional[str] = Header(None)):
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Missing token")
-    token = authorization.split(" ", 1)[1]
-    user_info = verify_token(token)
+def protected(user_info: dict = Depends(require_user)):
     return {"user": user_info}
 
 
@@ -214,128 +240,209 @@ async def logout():
 
 
 
-@app.post("/generate_questions/")
-def generate_questions(setup: GameSetup, authorization: Optional[str] = Header(None)):
-    # Token-based authentication
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Missing token")
-    token = authorization.split(" ", 1)[1]
-    user = verify_token(token)
-    if not user:
-        raise HTTPException(status_code=401, detail="Authentication required")
+# In-process store for question generation jobs, keyed by job id
+job_storage = {}
+job_lock = threading.Lock()
+JOB_TTL_SECONDS = 600
+JOB_MAX_WAIT_SECONDS = 30
+# Long-polls park a worker thread in Condition.wait_for; give them their own
+# limiter so they cannot exhaust the default threadpool that runs the jobs
+job_wait_limiter = anyio.CapacityLimiter(100)
+
+def prune_jobs():
+    cutoff = time.monotonic() - JOB_TTL_SECONDS
+    with job_lock:
+        for job_id in [k for k, job in job_storage.items() if job["created"] < cutoff]:
+            del job_storage[job_id]
+
+def run_generation_job(job_id, setup, user):
+    # Publish each question as soon as it exists so clients can start playing
+    job = job_storage[job_id]
+    try:
+        for question in iter_questions(setup, user):
+            with job["changed"]:
+                job["questions"].append(question)
+                job["changed"].notify_all()
+        status = "done"
+    except Exception as e:
+        job["error"] = str(e)
+        status = "error"
+    with job["changed"]:
+        job["status"] = status
+        job["changed"].notify_all()
+
+@app.post("/generate_questions/", status_code=202)
+def generate_questions(setup: GameSetup, background_tasks: BackgroundTasks, user: dict = Depends(require_user)):
+    """Queue question generation and return a job id to poll at /jobs/{job_id}."""
+    prune_jobs()
+    job_id = uuid.uuid4().hex
+    with job_lock:
+        job_storage[job_id] = {
+            "email": user["email"],
+            "status": "pending",
+            "questions": [],
+            "changed": threading.Condition(),
+            "created": time.monotonic(),
+        }
+    background_tasks.add_task(run_generation_job, job_id, setup, user)
+    return {"job_id": job_id}
+
+@app.get("/jobs/{job_id}")
+async def get_job(
+    job_id: str,
+    since: int = Query(0, ge=0),
+    wait: float = Query(0, ge=0, le=JOB_MAX_WAIT_SECONDS),
+    user: dict = Depends(require_user)
+):
+    """
+    Return a generation job's questions after the first `since`.
+    
+    Long-polls for up to `wait` seconds for new questions and answers 202 while
+    the job is still running with nothing new to report.
+    """
+    job = job_storage.get(job_id)
+    if job is None or job["email"] != user["email"]:
+        raise HTTPException(status_code=404, detail="Job not found")
+    def wait_for_update():
+        with job["changed"]:
+            job["changed"].wait_for(
+                lambda: len(job["questions"]) > since or job["status"] != "pending",
+                timeout=wait
+            )
+            return job["status"], job["questions"][since:]
+
+    status, questions = await anyio.to_thread.run_sync(wait_for_update, limiter=job_wait_limiter)
+    if status == "error":
+        raise HTTPException(status_code=500, detail=f"Failed to generate questions: {job['error']}")
+    if status == "pending" and not questions:
+        return ORJSONResponse(status_code=202, content={"job_id": job_id, "status": "pending", "questions": []})
+    return {"job_id": job_id, "status": status, "questions": questions}
 
-    questions = []
+def iter_questions(setup: GameSetup, user):
+    """Yield questions one at a time as they are generated."""
     db = SessionLocal()
 
-    if testing == False:
-        chosen_topic = random.choice(topics) if setup.topic == "random" else setup.topic
-        for round_num in range(setup.rounds):
-            for player in setup.players:
-                # Force prompt uniqueness by using player name and randomness
-                seed = random.randint(1000, 9999)
-                prompt = (
-                    f"You are a trivia question generator. "
-                    f"Create a fun, multiple-choice question for a {player.age}-year-old named {player.name}. "
-                    f"Topic: {chosen_topic}. Each question must be unique across players and not a repeat of previous question. "
-                    f"Inject creativity and age-appropriate fun. Format your output as a JSON object with these keys: "
-                    f"'question' (string), 'options' (list of 4 strings), and 'answer' (string). "
-                    f"Use this random context ID to vary the question: {seed}."
-                )
-                try:
-                    response = client.chat.completions.create(
-                        model="gpt-4",
-                        messages=[
-                            {"role": "system", "content": "You generate trivia questions in JSON format."},
-                            {"role": "user", "content": prompt}
-                        ],
-                        temperature=0.8
+    try:
+        if testing == False:
+            chosen_topic = random.choice(topics) if setup.topic == "random" else setup.topic
+            for round_num in range(setup.rounds):
+                for player_idx, player in enumerate(setup.players):
+                    # Force prompt uniqueness by using player name and randomness
+                    seed = random.randint(1000, 9999)
+                    prompt = (
+                        f"You are a trivia question generator. "
+                        f"Create a fun, multiple-choice question for a {player.age}-year-old named {player.name}. "
+                        f"Topic: {chosen_topic}. Each question must be unique across players and not a repeat of previous question. "
+                        f"Inject creativity and age-appropriate fun. Format your output as a JSON object with these keys: "
+                        f"'question' (string), 'options' (list of 4 strings), and 'answer' (string). "
+                        f"Use this random context ID to vary the question: {seed}."
                     )
-                    q_json = json.loads(response.choices[0].message.content)
-
-                    questions.append({
-                        "player": player.name,
-                        "age": player.age,
-                        "round": round_num + 1,
-                        "topic": chosen_topic,
-                        **q_json
-                    })
-                    # Save question to DB for user
-                    user_obj = db.query(User).filter(User.email == user["email"]).first()
-                    if user_obj:
-                        db.add(TriviaLog(
-                            user_id=user_obj.id,
-                            topic=chosen_topic,
-                            rounds=round_num + 1
-                        ))
-                        db.commit()
-                except Exception as e:
-                    questions.append({
-                        "email": user["email"],
-                        "player": player.name,
-                        "age": player.age,
-                        "round": round_num + 1,
-                        "topic": chosen_topic,
-                        "question": f"Error generating question: {str(e)}",
-                        "options": ["N/A", "N/A", "N/A", "N/A"],
-                        "answer": "N/A"
-                    })
-        print(questions)
-    elif testing == True:
-        # Mock questions here for testing
-        questions = [
-            {
-                "player": "Player1",
-                "age": 8,
-                "round": 1,
-                "topic": "Space",
-                "question": "Hey Player1, do you know what we call a group of stars that forms an imaginary picture in the sky?",
-                "options": ["A Star Party", "A Star Picnic", "A Star Cluster", "A Constellation"],
-                "answer": "A Constellation"
-            },
-            {
-                "player": "Player2",
-                "age": 8,
-                "round": 1,
-                "topic": "Space",
-                "question": "Hey Player2, did you know Outer Space is full of surprises? Can you guess what color the Sun is, from outer space?",
-                "options": ["Red", "Yellow", "Blue", "It's not there!"],
-                "answer": "Blue"
-            },
-            {
-                "player": "Player1",
-                "age": 8,
-                "round": 2,
-                "topic": "Space",
-                "question": "Hey, Player1! Which planet in our solar system is known as the 'Red Planet'?",
-                "options": ["A. Jupiter", "B. Pluto", "C. Mars", "D. Venus"],
-                "answer": "C. Mars"
-            },
-            {
-                "player": "Player2",
-                "age": 8,
-                "round": 2,
-                "topic": "Space",
-                "question": "Hey Player2, if you were on the moon, which of these things would be true?",
-                "options": [
-                    "You could eat as much ice cream as you want without feeling full",
-                    "Your favorite teddy bear would start to talk",
-                    "You would weigh less than you do on Earth",
-                    "Your sneakers could turn into rocket boots"
-                ],
-                "answer": "You would weigh less than you do on Earth"
-            }
-        ]
+                    try:
+                        response = client.chat.completions.create(
+                            model="gpt-4",
+                            messages=[
+                                {"role": "system", "content": "You generate trivia questions in JSON format."},
+                                {"role": "user", "content": prompt}
+                            ],
+                            temperature=0.8
+                        )
+                        q_json = orjson.loads(response.choices[0].message.content)
+
+                        yield {
+                            "player": player.name,
+                            "player_idx": player_idx,
+                            "age": player.age,
+                            "round": round_num + 1,
+                            "topic": chosen_topic,
+                            **q_json
+                        }
+                        # Save question to DB for user
+                        user_obj = db.query(User).filter(User.email == user["email"]).first()
+                        if user_obj:
+                            db.add(TriviaLog(
+                                user_id=user_obj.id,
+                                topic=chosen_topic,
+                                rounds=round_num + 1
+                            ))
+                            db.commit()
+                    except Exception as e:
+                        yield {
+                            "email": user["email"],
+                            "player": player.name,
+                            "player_idx": player_idx,
+                            "age": player.age,
+                            "round": round_num + 1,
+                            "topic": chosen_topic,
+                            "question": f"Error generating question: {str(e)}",
+                            "options": ["N/A", "N/A", "N/A", "N/A"],
+                            "answer": "N/A"
+                        }
+        elif testing == True:
+            # Mock questions here for testing
+            yield from [
+                {
+                    "player": "Player1",
+                    "player_idx": 0,
+                    "age": 8,
+                    "round": 1,
+                    "topic": "Space",
+                    "question": "Hey Player1, do you know what we call a group of stars that forms an imaginary picture in the sky?",
+                    "options": ["A Star Party", "A Star Picnic", "A Star Cluster", "A Constellation"],
+                    "answer": "A Constellation"
+                },
+                {
+                    "player": "Player2",
+                    "player_idx": 1,
+                    "age": 8,
+                    "round": 1,
+                    "topic": "Space",
+                    "question": "Hey Player2, did you know Outer Space is full of surprises? Can you guess what color the Sun is, from outer space?",
+                    "options": ["Red", "Yellow", "Blue", "It's not there!"],
+                    "answer": "Blue"
+                },
+                {
+                    "player": "Player1",
+                    "player_idx": 0,
+                    "age": 8,
+                    "round": 2,
+                    "topic": "Space",
+                    "question": "Hey, Player1! Which planet in our solar system is known as the 'Red Planet'?",
+                    "options": ["A. Jupiter", "B. Pluto", "C. Mars", "D. Venus"],
+                    "answer": "C. Mars"
+                },
+                {
+                    "player": "Player2",
+                    "player_idx": 1,
+                    "age": 8,
+                    "round": 2,
+                    "topic": "Space",
+                    "question": "Hey Player2, if you were on the moon, which of these things would be true?",
+                    "options": [
+                        "You could eat as much ice cream as you want without feeling full",
+                        "Your favorite teddy bear would start to talk",
+                        "You would weigh less than you do on Earth",
+                        "Your sneakers could turn into rocket boots"
+                    ],
+                    "answer": "You would weigh less than you do on Earth"
+                }
+            ]
+
+        db.commit()
+    finally:
+        db.close()
 
-    db.commit()
-    return {"questions": questions}
+# Per-user quiz counts in a single grouped query
+USER_QUIZ_STATS_STMT = (
+    select(User.name, User.email, func.count(TriviaLog.id))
+    .join(TriviaLog, User.id == TriviaLog.user_id)
+    .group_by(User.id)
+)
 
 @app.get("/user_quiz_stats")
 def user_quiz_stats():
-    db = SessionLocal()
-    # Alternatively, use a group by for efficiency
-    from sqlalchemy import func
-    stats = db.query(User.name, User.email, func.count(TriviaLog.id)).join(TriviaLog, User.id == TriviaLog.user_id).group_by(User.id).all()
-    db.close()
+    # Pure aggregate read: execute on a plain connection, no ORM Session needed
+    with engine.connect() as conn:
+        stats = conn.execute(USER_QUIZ_STATS_STMT).all()
     # Format output
     output = [
         {
@@ -347,22 +454,53 @@ def user_quiz_stats():
     ]
     return {"user_quiz_stats": output}
 
+# Dialects whose INSERT supports ON CONFLICT DO NOTHING ... RETURNING
+CONFLICT_INSERTS = {"sqlite": sqlite_insert, "postgresql": postgresql_insert}
+
+def claim_questions(db, user_id, question_ids):
+    """
+    Assign questions to a user and return the ids this call actually claimed.
+    The unique (user_id, question_id) index rejects rows a concurrent request
+    already claimed; those are skipped rather than failing the whole batch.
+    """
+    # Same clock as the UserQuestion.assigned_at default
+    assigned_at = datetime.utcnow()
+    rows = [
+        {"user_id": user_id, "question_id": question_id, "assigned_at": assigned_at, "seen": False}
+        for question_id in question_ids
+    ]
+    conflict_insert = CONFLICT_INSERTS.get(db.get_bind().dialect.name)
+    if conflict_insert is not None:
+        # One INSERT claims every candidate; RETURNING reports only the rows inserted
+        return set(db.scalars(
+            conflict_insert(UserQuestion)
+            .values(rows)
+            .on_conflict_do_nothing(index_elements=["user_id", "question_id"])
+            .returning(UserQuestion.question_id)
+        ))
+    
+    # Other dialects: insert row by row, each in a SAVEPOINT so a conflict only undoes that row
+    claimed_ids = set()
+    for row in rows:
+        try:
+            with db.begin_nested():
+                db.execute(insert(UserQuestion).values(row))
+        except IntegrityError:
+            continue
+        claimed_ids.add(row["question_id"])
+    return claimed_ids
+
 @app.get("/questions", response_model=List[QuestionResponse])
-def get_questions(limit: int = 10, age: Optional[int] = None, topic: Optional[str] = None, authorization: Optional[str] = Header(None)):
+def get_questions(limit: int = 10, age: Optional[List[int]] = Query(None), topic: Optional[str] = None, cursor: Optional[int] = None, user_info: dict = Depends(require_user)):
     """
     Get questions from database filtered by age, topic, and user assignment history.
+    `age` may be repeated (?age=7&age=10) to get questions suitable for any of the players.
     Phase 2: Includes per-user deduplication with atomic assignment.
     Users must authenticate to receive questions.
+    Results are ordered by question id; pass the last id seen as `cursor`
+    to continue after it (keyset pagination).
     """
-    # Phase 2: Require authentication
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Authentication required")
-    
-    token = authorization.split(" ", 1)[1]
-    user_info = verify_token(token)
-    if not user_info:
-        raise HTTPException(status_code=401, detail="Invalid token")
-    
+    # Phase 2: Authentication is required (see require_user)
     db = SessionLocal()
     try:
         # Get user from database
@@ -374,10 +512,10 @@ def get_questions(limit: int = 10, age: Optional[int] = None, topic: Optional[st
         # Find candidate questions filtered by age/topic and NOT already assigned to user
         query = db.query(Question)
         
-        # Apply age filtering if provided
-        if age is not None:
+        # Apply age filtering if provided; a question qualifies if it fits any given age
+        if age:
             query = query.filter(
-                (Question.min_age <= age) & (Question.max_age >= age)
+                or_(*((Question.min_age <= a) & (Question.max_age >= a) for a in age))
             )
         
         # Apply topic filtering if provided
@@ -385,34 +523,25 @@ def get_questions(limit: int = 10, age: Optional[int] = None, topic: Optional[st
             query = query.filter(Question.topic.ilike(f"%{topic}%"))
         
         # Phase 2: Exclude questions already assigned to this user
-        already_assigned_subquery = db.query(UserQuestion.question_id).filter(
-            UserQuestion.user_id == user.id
-        ).subquery()
-        
-        query = query.filter(
-            ~Question.id.in_(db.query(already_assigned_subquery.c.question_id))
-        )
+        # Correlated NOT EXISTS probes the (user_id, question_id) composite index
+        # per candidate instead of materializing the user's full assignment set
+        query = query.filter(~assigned_to(user.id))
+
+        # Keyset pagination: resume after the caller's last seen id
+        if cursor is not None:
+            query = query.filter(Question.id > cursor)
         
-        # Get available questions
-        available_questions = query.limit(limit).all()
+        # Get available questions in primary-key order so the scan stops at `limit`
+        available_questions = query.order_by(Question.id).limit(limit).all()
         
         if not available_questions:
             return []
         
         # Phase 2: Atomically assign questions to user
-        assigned_questions = []
-        for question in available_questions:
-            # Create user_question assignment record
-            user_question = UserQuestion(
-                user_id=user.id,
-                question_id=question.id,
-                assigned_at=datetime.now(),
-                seen=False
-            )
-            db.add(user_question)
-            
-            # Add to response
-            assigned_questions.append(QuestionResponse(
+        claimed_ids = claim_questions(db, user.id, [question.id for question in available_questions])
+        
+        assigned_questions = [
+            QuestionResponse(
                 id=question.id,
                 prompt=question.prompt,
                 options=question.options,
@@ -421,7 +550,10 @@ def get_questions(limit: int = 10, age: Optional[int] = None, topic: Optional[st
                 min_age=question.min_age,
                 max_age=question.max_age,
                 created_at=question.created_at.isoformat() if question.created_at else ""
-            ))
+            )
+            for question in available_questions
+            if question.id in claimed_ids
+        ]
         
         # Commit the assignments
         db.commit()
@@ -460,7 +592,7 @@ def import_questions(request: ImportRequest):
                 continue
             
             # Convert options list to JSON string
-            options_json = json.dumps(q_import.options)
+            options_json = orjson.dumps(q_import.options).decode()
             
             # Create new question
             question = Question(
@@ -478,7 +610,7 @@ def import_questions(request: ImportRequest):
         
         db.commit()
         
-        total_in_db = db.query(Question).count()
+        total_in_db = db.scalar(select(func.count()).select_from(Question))
         
         return ImportResponse(
             imported_count=imported_count,
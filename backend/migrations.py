@@ -0,0 +1,51 @@
+"""
+Schema migrations for databases created before a model change.
+
+create_all only creates missing tables, so changes to tables that already exist
+are applied here. The backend runs them on startup; `python -m backend.migrations`
+applies them ahead of time.
+"""
+import logging
+
+from sqlalchemy import delete, func, inspect, select, text
+
+from .database import engine
+from .models import UserQuestion
+
+logger = logging.getLogger(__name__)
+
+# Non-unique (user_id, question_id) index replaced by ux_user_question_assignment
+LEGACY_ASSIGNMENT_INDEX = "ix_user_question_composite"
+
+
+def migrate_unique_assignments(bind=engine):
+    """
+    Make (user_id, question_id) unique in user_questions.
+    Deletes duplicate assignments, keeping each pair's earliest row, drops the
+    old non-unique index and creates the unique one. Returns False if the
+    database already has the unique index.
+    """
+    unique_index = next(
+        index for index in UserQuestion.__table__.indexes if index.name == "ux_user_question_assignment"
+    )
+    with bind.begin() as conn:
+        existing = {index["name"] for index in inspect(conn).get_indexes(UserQuestion.__tablename__)}
+        if unique_index.name in existing:
+            return False
+
+        earliest = select(func.min(UserQuestion.id)).group_by(UserQuestion.user_id, UserQuestion.question_id)
+        removed = conn.execute(delete(UserQuestion).where(UserQuestion.id.not_in(earliest))).rowcount
+        logger.info("[MIGRATION] Removed %d duplicate question assignments", removed)
+
+        if LEGACY_ASSIGNMENT_INDEX in existing:
+            conn.execute(text(f"DROP INDEX {LEGACY_ASSIGNMENT_INDEX}"))
+        unique_index.create(conn)
+    return True
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if migrate_unique_assignments():
+        logger.info("[MIGRATION] Created unique index on user_questions(user_id, question_id)")
+    else:
+        logger.info("[MIGRATION] user_questions already has its unique index")
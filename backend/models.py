@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text, Boolean, Index
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text, Boolean, Index, exists
 from sqlalchemy.orm import declarative_base
 from datetime import datetime
 from .database import Base
@@ -59,7 +59,19 @@ class UserQuestion(Base):
     assigned_at = Column(DateTime, default=datetime.utcnow)             # When assignment occurred
     seen = Column(Boolean, default=False)                              # Whether user has seen/answered it
     
-    # Composite index for efficient user+question lookups
+    # Unique composite index: efficient user+question lookups, and the database
+    # rejects a second assignment of the same question to the same user
     __table_args__ = (
-        Index('ix_user_question_composite', 'user_id', 'question_id'),
+        Index('ux_user_question_assignment', 'user_id', 'question_id', unique=True),
+    )
+
+
+def assigned_to(user_id):
+    """
+    Correlated EXISTS: the enclosing query's Question is already assigned to the user.
+    Filter with ~assigned_to(user_id) to keep only unseen questions; each candidate
+    is one probe of the (user_id, question_id) unique index.
+    """
+    return exists().where(
+        (UserQuestion.user_id == user_id) & (UserQuestion.question_id == Question.id)
     )
@@ -2,93 +2,234 @@ from dotenv import load_dotenv
 import os
 import streamlit as st
 import requests
-import random
-from urllib.parse import urlencode
+import orjson
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import time
+from types import SimpleNamespace
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
+from http.cookiejar import DefaultCookiePolicy
 
 # Constants
-load_dotenv()
+# .env is read once per server process rather than on every rerun
+@st.cache_resource
+def config():
+    load_dotenv()
+    return SimpleNamespace(
+        BACKEND_URL=os.getenv("BACKEND_URL", "http://localhost:8000")
+    )
 
-BACKEND_URL = os.getenv("BACKEND_URL", "http://localhost:8000")
+BACKEND_URL = config().BACKEND_URL
 #BACKEND_URL = "http://localhost:8000"  # or your deployed backend
+REQUEST_TIMEOUT = 10  # seconds; a hung backend must not hang the app
+
+# One pooled HTTP session per server process so reruns reuse keep-alive connections.
+# Sharing it across script threads is safe because it holds no per-user state:
+# every call passes its own Authorization header, cookies are refused, and the
+# adapter is never remounted after this point. urllib3's pools are thread-safe.
+@st.cache_resource
+def get_session():
+    session = requests.Session()
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    retries = Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retries)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+# Decode response bodies with orjson rather than requests' stdlib json
+def _json(res):
+    return orjson.loads(res.content)
+
+# Shared worker pool for backend calls that can overlap with rendering
+@st.cache_resource
+def get_executor():
+    return ThreadPoolExecutor(max_workers=4)
 
 #############################
 ## Auth Items
 #############################
 
 
-# Initialize session state
-if "token" not in st.session_state:
-    st.session_state.token = None
-if "user" not in st.session_state:
-    st.session_state.user = None
-if "auth_checked" not in st.session_state:
-    st.session_state.auth_checked = False
+# Initialize session state; the literal is rebuilt each run, so the mutable
+# defaults are never shared between sessions
+DEFAULTS = {
+    "token": None,
+    "user": None,
+    "auth_checked": False,
+    "auth_future": None,
+    "me_etag": None,
+    "questions": [],
+    "current_index": 0,
+    "scores": [],
+    "player_names": [],
+    "answers": {},
+    "exit_quiz": False,
+    "quiz_loading": False,
+    "setup": None,
+    "setup_error": None,
+    "job_id": None,
+    "generation_done": False,
+}
+GAME_KEYS = ("questions", "current_index", "scores", "player_names", "answers", "job_id", "generation_done")
+
+for key, value in DEFAULTS.items():
+    st.session_state.setdefault(key, value)
+
+def reset_game():
+    st.session_state.update({key: DEFAULTS[key] for key in GAME_KEYS})
 
 # Show login UI if not authenticated
 
 def show_login():
     st.warning("Please login to continue.")
     login_url = f"{BACKEND_URL}/login"
-    st.title("🧠 Multiplayer Trivia Game")
     if st.button("Login with Google"):
         st.write("Redirecting to Google...")
         st.markdown(f'<meta http-equiv="refresh" content="0;url={login_url}">', unsafe_allow_html=True)
     st.stop()
 
+# Validate a token against /me; cached per token so reruns skip the round-trip.
+# The underscored args are not hashed: when the cache entry expires we send the
+# last ETag and keep the held user on a 304. Any other status raises, so a
+# rejected token or a backend hiccup is never cached.
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _validate_token(token, _user=None, _etag=None):
+    headers = {"Authorization": f"Bearer {token}"}
+    if _user is not None and _etag:
+        headers["If-None-Match"] = _etag
+    res = get_session().get(f"{BACKEND_URL}/me", headers=headers, timeout=REQUEST_TIMEOUT)
+    if res.status_code == 304:
+        return _user, _etag
+    if res.status_code == 200:
+        return _json(res), res.headers.get("ETag")
+    raise requests.HTTPError(f"/me returned {res.status_code}", response=res)
+
+def submit_validation():
+    return get_executor().submit(
+        _validate_token,
+        st.session_state.token,
+        st.session_state.user,
+        st.session_state.me_etag
+    )
+
+# Start validating the token in the background so /me overlaps with rendering
+
+def start_auth():
+    if st.session_state.auth_checked and st.session_state.user is not None:
+        return
+    # Check for token in URL (after OAuth)
+    query_params = st.query_params
+    if "token" in query_params:
+        st.session_state.token = query_params["token"]
+        query_params.clear()
+    if st.session_state.token and st.session_state.auth_future is None:
+        st.session_state.auth_future = submit_validation()
+
 # Check user authentication via backend
 
 def check_auth():
-    if st.session_state.auth_checked:
+    if st.session_state.auth_checked and st.session_state.user is not None:
         return
+    if not st.session_state.token:
+        show_login()
     try:
-        # Check for token in URL (after OAuth)
-        query_params = st.query_params
-        if "token" in query_params:
-            st.session_state.token = query_params["token"]
-            query_params.clear()
-            st.rerun()
-        if not st.session_state.token:
-            show_login()
-        headers = {"Authorization": f"Bearer {st.session_state.token}"}
-        res = requests.get(f"{BACKEND_URL}/me", headers=headers)
-        if res.status_code == 200:
-            st.session_state.user = res.json()
-            st.session_state.auth_checked = True
-            return
-        else:
-            st.session_state.token = None
-            show_login()
+        future = st.session_state.auth_future
+        if future is None:
+            future = submit_validation()
+        st.session_state.auth_future = None
+        st.session_state.user, st.session_state.me_etag = future.result(timeout=10)
+        st.session_state.auth_checked = True
+    except requests.HTTPError:
+        st.session_state.token = None
+        show_login()
     except Exception as e:
         st.error(f"Auth check failed: {e}")
         st.stop()
 
 # Backend wrappers with proper session handling
 
-def backend_get(path, **kwargs):
-    headers = kwargs.pop("headers", {})
+def _auth_headers():
     if st.session_state.token:
-        headers["Authorization"] = f"Bearer {st.session_state.token}"
-    response = requests.get(f"{BACKEND_URL}{path}", headers=headers, **kwargs)
-    if response.status_code == 401:
-        show_login()
-    return response
+        return {"Authorization": f"Bearer {st.session_state.token}"}
+    return {}
 
-def backend_post(path, json=None):
-    headers = {}
-    if st.session_state.token:
-        headers["Authorization"] = f"Bearer {st.session_state.token}"
-    response = requests.post(f"{BACKEND_URL}{path}", json=json, headers=headers)
+def _request(method, path, **kwargs):
+    headers = {**_auth_headers(), **kwargs.pop("headers", {})}
+    kwargs.setdefault("timeout", REQUEST_TIMEOUT)
+    response = get_session().request(method, f"{BACKEND_URL}{path}", headers=headers, **kwargs)
     if response.status_code == 401:
+        st.session_state.token = None
+        st.session_state.user = None
+        st.session_state.auth_checked = False
         show_login()
     return response
 
+def backend_get(path, **kwargs):
+    return _request("GET", path, **kwargs)
+
+def backend_post(path, json=None, **kwargs):
+    return _request("POST", path, json=json, **kwargs)
+
+# Question generation is an LLM call the backend runs as a job. The job id is
+# kept in session state so reruns during the same Start Game click never queue a
+# second job. Questions are then pulled from the job as they are generated, so
+# play starts with the first one.
+
+JOB_POLL_WAIT_SECONDS = 25
+GENERATION_TIMEOUT_SECONDS = 180
+
+def start_generation(players, rounds, topic):
+    setup = {
+        "players": [{"name": name, "age": age} for name, age in players],
+        "rounds": rounds,
+        "topic": topic
+    }
+    res = get_session().post(
+        f"{BACKEND_URL}/generate_questions/",
+        json=setup,
+        headers=_auth_headers(),
+        timeout=REQUEST_TIMEOUT
+    )
+    res.raise_for_status()
+    return _json(res)["job_id"]
+
+def poll_questions(wait=0):
+    # Long-polls up to `wait` seconds for questions we don't have yet
+    res = backend_get(
+        f"/jobs/{st.session_state.job_id}",
+        params={"since": len(st.session_state.questions), "wait": wait},
+        timeout=wait + REQUEST_TIMEOUT
+    )
+    res.raise_for_status()
+    job = _json(res)
+    st.session_state.questions.extend(job["questions"])
+    st.session_state.generation_done = job["status"] == "done"
+
+def wait_for_next_question():
+    # Each poll returns as soon as a question lands, so no backoff is needed;
+    # the deadline bounds this one wait, not the game, so a stuck job is not
+    # polled forever while a long game keeps getting its later questions
+    deadline = time.monotonic() + GENERATION_TIMEOUT_SECONDS
+    while (st.session_state.current_index >= len(st.session_state.questions)
+           and not st.session_state.generation_done):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"no question after {GENERATION_TIMEOUT_SECONDS}s")
+        poll_questions(wait=min(JOB_POLL_WAIT_SECONDS, remaining))
+
 # Logout function
 
 def logout():
     try:
         res = backend_post("/logout")
         if res.status_code == 200:
+            # Only this session forgets the token; the shared _validate_token
+            # cache keeps every other user's entry
             st.session_state.user = None
+            st.session_state.me_etag = None
             st.session_state.auth_checked = False
             st.session_state.token = None
             st.rerun()
@@ -97,14 +238,16 @@ def logout():
 
 ############## Main App ###########################
 
-# Check auth before rendering anything
+# Kick off auth, render the static header, then wait for the result
+start_auth()
+
+st.title("🧠 Multiplayer Trivia Game")
+
 check_auth()
 
 if not st.session_state.user:
     show_login()
 
-st.title("🧠 Multiplayer Trivia Game")
-
 # User info and logout button
 col1, col2 = st.columns([4, 1])
 with col1:
@@ -113,82 +256,115 @@ with col2:
     if st.button("Logout"):
         logout()
 
-# Session state setup
-if "questions" not in st.session_state:
-    st.session_state.questions = []
-    st.session_state.current_index = 0
-    st.session_state.scores = {}
-    st.session_state.answers = {}
-    st.session_state.exit_quiz = False
-
 # Setup form
-if not st.session_state.questions:
+if not st.session_state.questions and not st.session_state.quiz_loading:
     st.header("Game Setup")
+    if st.session_state.setup_error:
+        st.error(st.session_state.setup_error)
+        st.session_state.setup_error = None
+    # The player count drives how many rows the form shows, so it stays outside;
+    # everything else is batched into the form and only reruns on submit
     num_players = st.number_input("Number of players", 1, 5, 2)
-    players = []
-    for i in range(num_players):
-        name = st.text_input(f"Player {i+1} Name", f"Player{i+1}")
-        age = st.number_input(f"{name}'s Age", 3, 99, 8, key=f"age_{i}")
-        players.append({"name": name, "age": age})
-    rounds = st.slider("Rounds", 1, 5, 2)
-    topic = st.selectbox("Topic", ["random", "Animals", "Space", "Science", "History", "Sports"])
-    # Add a spinner state to prevent multiple clicks
-    if "quiz_loading" not in st.session_state:
-        st.session_state.quiz_loading = False
-    # Button click: set loading and rerun
-    if not st.session_state.quiz_loading:
-        if st.button("Start Game", key="start_quiz_btn"):
-            st.session_state.quiz_loading = True
-            st.rerun()
-    # After rerun, show spinner and generate questions
-    elif st.session_state.quiz_loading:
-        with st.spinner("Generating questions..."):
-            setup = {
-                "players": players,
-                "rounds": rounds,
-                "topic": topic
-            }
-            for i in range(num_players):
-                st.session_state.scores[players[i]["name"]] = 0
-            res = backend_post("/generate_questions/", json=setup)
-            st.session_state.quiz_loading = False
-            if res.status_code == 200:
-                st.session_state.questions = res.json()["questions"]
-                st.rerun()
-            else:
-                st.error(f"Failed to load questions. Status: {res.status_code}")
+    with st.form("setup_form"):
+        players = []
+        for i in range(num_players):
+            name = st.text_input(f"Player {i+1} Name", f"Player{i+1}")
+            age = st.number_input(f"{name}'s Age", 3, 99, 8, key=f"age_{i}")
+            players.append({"name": name, "age": age})
+        rounds = st.slider("Rounds", 1, 5, 2)
+        topic = st.selectbox("Topic", ["random", "Animals", "Space", "Science", "History", "Sports"])
+        submitted = st.form_submit_button("Start Game")
+    # Submit: remember the setup, set loading and rerun
+    if submitted:
+        st.session_state.setup = {
+            "players": tuple((p["name"], p["age"]) for p in players),
+            "rounds": rounds,
+            "topic": topic
+        }
+        st.session_state.quiz_loading = True
+        st.session_state.job_id = None
+        st.rerun()
+# After rerun, show only the spinner while the first questions are generated;
+# the form is not rendered, so nothing on the page can trigger another rerun
+elif not st.session_state.questions:
+    setup = st.session_state.setup
+    with st.spinner("Generating questions..."):
+        # Scores are indexed by each question's player_idx
+        st.session_state.player_names = [name for name, _ in setup["players"]]
+        st.session_state.scores = [0] * len(setup["players"])
+        try:
+            if st.session_state.job_id is None:
+                st.session_state.job_id = start_generation(
+                    setup["players"],
+                    setup["rounds"],
+                    setup["topic"]
+                )
+            wait_for_next_question()
+        except requests.HTTPError as e:
+            if e.response.status_code == 401:
+                st.session_state.quiz_loading = False
+                show_login()
+            st.session_state.setup_error = f"Failed to load questions. Status: {e.response.status_code}"
+        except (requests.RequestException, TimeoutError) as e:
+            st.session_state.setup_error = f"Failed to load questions: {e}"
+        else:
+            if not st.session_state.questions:
+                st.session_state.setup_error = "Failed to load questions. None were generated."
+    # Back to the form on failure, into the game on success
+    st.session_state.quiz_loading = False
+    st.rerun()
 # Game Loop
-elif st.session_state.current_index < len(st.session_state.questions):
+elif (st.session_state.current_index < len(st.session_state.questions)
+      or not st.session_state.generation_done):
+    if not st.session_state.generation_done:
+        # Pick up whatever was generated meanwhile; only block when the next
+        # question is not there yet
+        try:
+            poll_questions()
+            if st.session_state.current_index >= len(st.session_state.questions):
+                with st.spinner("Generating the next question..."):
+                    wait_for_next_question()
+        except (requests.RequestException, TimeoutError) as e:
+            # A toast survives the rerun below, unlike st.error
+            st.session_state.generation_done = True
+            st.toast(f"Failed to load more questions: {e}")
+        if st.session_state.current_index >= len(st.session_state.questions):
+            st.rerun()
     q = st.session_state.questions[st.session_state.current_index]
-    current_player = q['player']
     st.subheader(f"Round {q['round']} - {q['player']}")
     st.markdown(f"**Question:** {q['question']}")
-    selected = st.radio("Choose your answer:", q["options"], key=f"q{st.session_state.current_index}")
+    answer_key = f"q{st.session_state.current_index}"
+    selected = st.radio("Choose your answer:", q["options"], key=answer_key)
     col1, col2 = st.columns(2)
     with col1:
         if st.button("Submit Answer"):
             if selected == q["answer"]:
                 st.success("✅ Correct!")
-                st.session_state.scores[current_player] += 1
+                st.session_state.scores[q["player_idx"]] += 1
             else:
                 st.error(f"❌ Wrong! Correct answer: {q['answer']}")
             st.session_state.current_index += 1
+            # Drop the answered radio's state so keys don't pile up per question
+            st.session_state.pop(answer_key, None)
             st.rerun()
     with col2:
         if st.button("❌ Exit Quiz"):
             st.session_state.exit_quiz = True
-            for key in ["questions", "current_index", "scores", "answers"]:
-                del st.session_state[key]
+            st.session_state.pop(answer_key, None)
+            reset_game()
             st.rerun()
 
 # Game Over
 else:
     st.success("🎉 Game Over!")
     st.header("Final Scores")
-    sorted_scores = sorted(st.session_state.scores.items(), key=lambda x: x[1], reverse=True)
-    for player, score in sorted_scores:
-        st.write(f"**{player}:** {score} points")
+    sorted_scores = sorted(
+        zip(st.session_state.player_names, st.session_state.scores),
+        key=itemgetter(1),
+        reverse=True
+    )
+    # One markdown element for the whole board instead of one per player
+    st.markdown("  \n".join(f"**{player}:** {score} points" for player, score in sorted_scores))
     if st.button("Play Again"):
-        for key in ["questions", "current_index", "scores", "answers"]:
-            del st.session_state[key]
+        reset_game()
         st.rerun()
\ No newline at end of file
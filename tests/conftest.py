@@ -0,0 +1,112 @@
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from fastapi.testclient import TestClient
+
+from backend.models import Base
+from tests.db_utils import create_test_engine
+
+
+@pytest.fixture
+def test_engine(tmp_path):
+    """Create a per-test WAL database."""
+    engine = create_test_engine(tmp_path / "test.db")
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture(scope="module")
+def module_engine(tmp_path_factory):
+    """Create one WAL database shared by a whole test module."""
+    engine = create_test_engine(tmp_path_factory.mktemp("db") / "test.db")
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture(scope="session")
+def engine():
+    """
+    Create one in-memory database for the session.
+    StaticPool keeps its single connection alive so the schema persists.
+    """
+    engine = create_engine(
+        "sqlite://",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool
+    )
+
+    @event.listens_for(engine, "connect")
+    def configure_connection(dbapi_connection, connection_record):
+        # pysqlite's own transaction handling breaks SAVEPOINT; let SQLAlchemy emit BEGIN
+        dbapi_connection.isolation_level = None
+        # Test data is throwaway: skip durability and journal bookkeeping
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA synchronous=OFF")
+        cursor.execute("PRAGMA journal_mode=MEMORY")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+
+    @event.listens_for(engine, "begin")
+    def emit_begin(conn):
+        conn.exec_driver_sql("BEGIN")
+
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture(scope="session")
+def tables(engine):
+    """Create the schema once per session."""
+    Base.metadata.create_all(bind=engine)
+
+
+@pytest.fixture
+def db_connection(engine, tables):
+    """Run a test inside an outer transaction that is rolled back afterwards."""
+    connection = engine.connect()
+    transaction = connection.begin()
+    yield connection
+    transaction.rollback()
+    connection.close()
+
+
+@pytest.fixture
+def test_db(db_connection, monkeypatch):
+    """Create a test session whose writes, and the app's, roll back after the test."""
+    # Session commits release a SAVEPOINT instead of ending the outer transaction
+    TestingSessionLocal = sessionmaker(
+        autoflush=False, expire_on_commit=False, bind=db_connection, join_transaction_mode="create_savepoint"
+    )
+    
+    # Endpoints open sessions from backend.main.SessionLocal directly
+    monkeypatch.setattr("backend.main.SessionLocal", TestingSessionLocal)
+    
+    db = TestingSessionLocal()
+    yield db
+    db.close()
+
+
+@pytest.fixture(scope="session")
+def client():
+    """Create one test client for the session; requests read the app state lazily."""
+    # Imported here so runs that never request a client skip loading the app
+    from backend.main import app
+    with TestClient(app) as c:
+        yield c
+
+
+@pytest.fixture
+def auth_as():
+    """Return a function that authenticates every request as the given user info."""
+    from backend.main import app, require_user
+    
+    def login(user_info):
+        app.dependency_overrides[require_user] = lambda: user_info
+    # Restore whatever override was installed before rather than assuming none
+    previous = app.dependency_overrides.get(require_user)
+    yield login
+    if previous is None:
+        app.dependency_overrides.pop(require_user, None)
+    else:
+        app.dependency_overrides[require_user] = previous
@@ -0,0 +1,49 @@
+from functools import cache
+
+from sqlalchemy import create_engine, event, insert
+
+from backend.models import Base, UserQuestion
+
+# JSON for ["A<i>", "B<i>", "C<i>", "D<i>"], filled in without a JSON encoder
+NUMBERED_OPTIONS = '["A%d","B%d","C%d","D%d"]'
+
+
+def create_test_engine(path):
+    """
+    Create a SQLite database file in WAL mode with the schema in place.
+    WAL lets readers run alongside the single writer, so threaded requests
+    don't queue behind each other; it needs a file, not :memory:.
+    """
+    engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA busy_timeout=5000")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+
+    Base.metadata.create_all(bind=engine)
+    return engine
+
+
+def clear_tables(engine):
+    """Delete every row, children first, leaving the schema for the next test."""
+    with engine.begin() as conn:
+        for table in reversed(Base.metadata.sorted_tables):
+            conn.execute(table.delete())
+
+
+def assign_all(db, user_id, question_ids):
+    """Record every question as assigned to the user in one executemany INSERT."""
+    db.execute(insert(UserQuestion), [
+        {"user_id": user_id, "question_id": question_id} for question_id in question_ids
+    ])
+
+
+@cache
+def numbered_options(i):
+    """Return the options JSON for question i, formatted once per index."""
+    return NUMBERED_OPTIONS % (i, i, i, i)
@@ -0,0 +1,114 @@
+import pytest
+from sqlalchemy import insert, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from backend.models import User, Question, UserQuestion, assigned_to
+from tests.db_utils import numbered_options
+
+
+@pytest.fixture(scope="class")
+def class_connection(engine, tables):
+    """Hold one outer transaction for a whole test class, rolled back afterwards."""
+    connection = engine.connect()
+    transaction = connection.begin()
+    yield connection
+    transaction.rollback()
+    connection.close()
+
+
+@pytest.fixture(scope="class")
+def hundred_questions(class_connection):
+    """Insert a user and 100 questions once per class; returns (user_id, question_ids)."""
+    user_id = class_connection.scalar(
+        insert(User).values(email="perf@example.com", name="Perf User", picture="pic.jpg")
+        .returning(User.id)
+    )
+    class_connection.execute(insert(Question), [
+        {
+            "prompt": f"Question {i}",
+            "options": numbered_options(i),
+            "answer": f"A{i}",
+            "topic": "Test",
+            "min_age": 8,
+            "max_age": 15,
+            "hash": f"hash{i}"
+        }
+        for i in range(100)
+    ])
+    question_ids = class_connection.scalars(select(Question.id).order_by(Question.id)).all()
+    return user_id, question_ids
+
+
+@pytest.fixture
+def test_db(class_connection):
+    """Create a session whose commits are rolled back after the test; no app involved."""
+    # Each test runs inside its own SAVEPOINT so the shared class data stays untouched
+    savepoint = class_connection.begin_nested()
+    db = Session(
+        bind=class_connection, autoflush=False, expire_on_commit=False,
+        join_transaction_mode="create_savepoint"
+    )
+    yield db
+    db.close()
+    savepoint.rollback()
+
+
+class TestDeduplicationPerformance:
+    """Test performance aspects of deduplication."""
+    
+    def test_composite_index_usage(self, test_db, hundred_questions):
+        """Test that queries can efficiently use the composite index."""
+        user_id, question_ids = hundred_questions
+        
+        # Assign half the questions
+        assigned_ids = question_ids[:50]
+        test_db.execute(insert(UserQuestion), [
+            {"user_id": user_id, "question_id": question_id} for question_id in assigned_ids
+        ])
+        test_db.commit()
+        
+        # Correlated NOT EXISTS: each question is one probe of the (user_id, question_id) index
+        available_questions = test_db.query(Question).filter(~assigned_to(user_id)).all()
+        
+        # Should get the unassigned half
+        assert len(available_questions) == 50
+        
+        # Verify correct questions returned
+        available_ids = [q.id for q in available_questions]
+        
+        assert len(set(assigned_ids) & set(available_ids)) == 0  # No overlap
+        assert len(assigned_ids) + len(available_ids) == 100  # All questions accounted for
+
+
+class TestDeduplicationConsistency:
+    """Test consistency guarantees of the assignment table."""
+    
+    def test_no_double_assignments(self, test_db, hundred_questions):
+        """Test that no question gets assigned twice to the same user."""
+        user_id, question_ids = hundred_questions
+        question_id = question_ids[0]
+        
+        # Create first assignment
+        assignment1 = UserQuestion(user_id=user_id, question_id=question_id)
+        test_db.add(assignment1)
+        test_db.commit()
+        
+        # Duplicate assignment is rejected by the unique (user_id, question_id) index
+        assignment2 = UserQuestion(user_id=user_id, question_id=question_id)
+        test_db.add(assignment2)
+        with pytest.raises(IntegrityError):
+            test_db.commit()
+        test_db.rollback()
+        
+        assert test_db.query(UserQuestion).filter(
+            UserQuestion.user_id == user_id,
+            UserQuestion.question_id == question_id
+        ).count() == 1
+        
+        # Verify the deduplication query works correctly
+        available_questions = test_db.query(Question).filter(~assigned_to(user_id)).all()
+        
+        # The assigned question should not be in available questions
+        available_ids = [q.id for q in available_questions]
+        assert question_id not in available_ids
\ No newline at end of file
@@ -1,97 +1,62 @@
 import pytest
 import json
 import hashlib
-from unittest.mock import patch, MagicMock
-from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
+from unittest.mock import patch
+from sqlalchemy import create_engine, func, insert, select
 from sqlalchemy.orm import sessionmaker
-from itsdangerous import URLSafeTimedSerializer
 
-from backend.main import app
-from backend.models import Base, User, Question, UserQuestion
-from backend.database import SessionLocal
+from backend.models import User, Question, UserQuestion
 
 
-# Test database fixture
-@pytest.fixture
-def test_db():
-    """Create a test database in memory."""
-    engine = create_engine("sqlite:///:memory:")
-    Base.metadata.create_all(bind=engine)
-    TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-    
-    def override_get_db():
-        db = TestingSessionLocal()
-        try:
-            yield db
-        finally:
-            db.close()
-    
-    # Override the database dependency
-    app.dependency_overrides[SessionLocal] = override_get_db
-    
-    db = TestingSessionLocal()
-    yield db
-    db.close()
-    
-    # Clean up
-    app.dependency_overrides.clear()
+# Sample questions, with the import endpoint's prompt + answer hash computed once at import
+SAMPLE_QUESTIONS_DATA = (
+    {
+        'prompt': 'What is the largest planet?',
+        'options': json.dumps(['Jupiter', 'Saturn', 'Earth', 'Mars']),
+        'answer': 'Jupiter',
+        'topic': 'Space',
+        'min_age': 8,
+        'max_age': 15
+    },
+    {
+        'prompt': 'What is 2+2?',
+        'options': json.dumps(['3', '4', '5', '6']),
+        'answer': '4',
+        'topic': 'Math',
+        'min_age': 5,
+        'max_age': 10
+    },
+    {
+        'prompt': 'Who wrote Romeo and Juliet?',
+        'options': json.dumps(['Shakespeare', 'Dickens', 'Austen', 'Twain']),
+        'answer': 'Shakespeare',
+        'topic': 'Literature',
+        'min_age': 12,
+        'max_age': 18
+    }
+)
+SAMPLE_QUESTION_ROWS = tuple(
+    {**q_data, 'hash': hashlib.sha256(f"{q_data['prompt']}{q_data['answer']}".encode()).hexdigest()[:16]}
+    for q_data in SAMPLE_QUESTIONS_DATA
+)
+
+
+# The auth dependency is overridden in these tests, so any bearer token will do
+HEADERS = {"Authorization": "Bearer valid_token"}
 
 
 @pytest.fixture
-def client():
-    """Create a test client."""
-    return TestClient(app)
+def stats_engine(test_engine, monkeypatch):
+    """Point the app's plain-connection reads at a per-test database."""
+    monkeypatch.setattr("backend.main.engine", test_engine)
+    return test_engine
 
 
 @pytest.fixture
 def sample_questions(test_db):
     """Create sample questions in test database."""
-    questions_data = [
-        {
-            'prompt': 'What is the largest planet?',
-            'options': json.dumps(['Jupiter', 'Saturn', 'Earth', 'Mars']),
-            'answer': 'Jupiter',
-            'topic': 'Space',
-            'min_age': 8,
-            'max_age': 15
-        },
-        {
-            'prompt': 'What is 2+2?',
-            'options': json.dumps(['3', '4', '5', '6']),
-            'answer': '4',
-            'topic': 'Math',
-            'min_age': 5,
-            'max_age': 10
-        },
-        {
-            'prompt': 'Who wrote Romeo and Juliet?',
-            'options': json.dumps(['Shakespeare', 'Dickens', 'Austen', 'Twain']),
-            'answer': 'Shakespeare',
-            'topic': 'Literature',
-            'min_age': 12,
-            'max_age': 18
-        }
-    ]
-    
-    questions = []
-    for q_data in questions_data:
-        content_hash = hashlib.sha256(f"{q_data['prompt']}{q_data['answer']}".encode()).hexdigest()[:16]
-        question = Question(
-            prompt=q_data['prompt'],
-            options=q_data['options'],
-            answer=q_data['answer'],
-            topic=q_data['topic'],
-            min_age=q_data['min_age'],
-            max_age=q_data['max_age'],
-            hash=content_hash
-        )
-        questions.append(question)
-    
-    test_db.add_all(questions)
+    test_db.execute(insert(Question), SAMPLE_QUESTION_ROWS)
     test_db.commit()
-    
-    return questions
 
 
 @pytest.fixture
@@ -108,16 +73,10 @@ def test_user(test_db):
 
 
 @pytest.fixture
-def auth_token():
-    """Create a valid authentication token."""
-    SECRET_KEY = "test_secret_key"
-    serializer = URLSafeTimedSerializer(SECRET_KEY)
-    user_info = {
-        'email': 'test@example.com',
-        'name': 'Test User',
-        'picture': 'https://example.com/avatar.jpg'
-    }
-    return serializer.dumps(user_info)
+def authed_client(client, auth_as, test_db, sample_questions, test_user):
+    """Return the client with sample questions seeded and requests authenticated as the test user."""
+    auth_as({"email": test_user.email, "name": test_user.name})
+    return client
 
 
 class TestBasicEndpoints:
@@ -128,6 +87,35 @@ class TestBasicEndpoints:
         assert response.json() == {"message": "Trivia backend is running!"}
 
 
+class TestMeEndpoint:
+    """Test GET /me conditional responses."""
+    
+    def test_me_returns_etag(self, client, auth_as):
+        """Test that /me tags the user payload with an ETag."""
+        auth_as({"email": "test@example.com", "name": "Test User"})
+        
+        response = client.get("/me", headers={"Authorization": "Bearer valid_token"})
+        assert response.status_code == 200
+        assert response.json()["email"] == "test@example.com"
+        assert response.headers["ETag"].startswith('"')
+    
+    def test_me_not_modified(self, client, auth_as):
+        """Test that a matching If-None-Match gets an empty 304."""
+        auth_as({"email": "test@example.com", "name": "Test User"})
+        headers = {"Authorization": "Bearer valid_token"}
+        etag = client.get("/me", headers=headers).headers["ETag"]
+        
+        response = client.get("/me", headers={**headers, "If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.content == b""
+        
+        # A changed profile no longer matches
+        auth_as({"email": "test@example.com", "name": "Renamed"})
+        response = client.get("/me", headers={**headers, "If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+
+
 class TestQuestionsEndpointPhase1:
     """Test GET /questions endpoint without authentication (Phase 1 behavior)."""
     
@@ -147,14 +135,9 @@ class TestQuestionsEndpointPhase1:
 class TestQuestionsEndpointPhase2:
     """Test GET /questions endpoint with authentication and deduplication (Phase 2)."""
     
-    @patch('backend.main.verify_token')
-    def test_get_questions_authenticated(self, mock_verify_token, client, test_db, sample_questions, test_user):
+    def test_get_questions_authenticated(self, authed_client):
         """Test authenticated request returns questions."""
-        # Mock authentication
-        mock_verify_token.return_value = {"email": "test@example.com", "name": "Test User"}
-        
-        headers = {"Authorization": "Bearer valid_token"}
-        response = client.get("/questions?limit=2", headers=headers)
+        response = authed_client.get("/questions?limit=2", headers=HEADERS)
         
         assert response.status_code == 200
         questions = response.json()
@@ -162,53 +145,30 @@ class TestQuestionsEndpointPhase2:
         assert all(q["id"] for q in questions)
         assert all(q["prompt"] for q in questions)
     
-    @patch('backend.main.verify_token')
-    def test_age_filtering(self, mock_verify_token, client, test_db, sample_questions, test_user):
-        """Test age-based filtering."""
-        mock_verify_token.return_value = {"email": "test@example.com", "name": "Test User"}
-        
-        headers = {"Authorization": "Bearer valid_token"}
-        
-        # Test age=8 (should get Space and Math questions)
-        response = client.get("/questions?age=8", headers=headers)
+    @pytest.mark.parametrize("query,expected_topics", [
+        # age=8 matches Space (8-15) and Math (5-10) but not Literature (12-18)
+        ("age=8", ["Math", "Space"]),
+        # Repeated ages match questions suitable for any of them
+        ("age=6&age=13", ["Literature", "Math", "Space"]),
+        ("topic=Math", ["Math"]),
+    ])
+    def test_filtering(self, authed_client, query, expected_topics):
+        """Test age- and topic-based filtering."""
+        response = authed_client.get(f"/questions?{query}", headers=HEADERS)
         assert response.status_code == 200
-        questions = response.json()
-        topics = [q["topic"] for q in questions]
-        assert "Space" in topics
-        assert "Math" in topics
-        assert "Literature" not in topics  # min_age=12 > 8
+        assert sorted(q["topic"] for q in response.json()) == expected_topics
     
-    @patch('backend.main.verify_token')
-    def test_topic_filtering(self, mock_verify_token, client, test_db, sample_questions, test_user):
-        """Test topic-based filtering."""
-        mock_verify_token.return_value = {"email": "test@example.com", "name": "Test User"}
-        
-        headers = {"Authorization": "Bearer valid_token"}
-        
-        # Test specific topic
-        response = client.get("/questions?topic=Math", headers=headers)
-        assert response.status_code == 200
-        questions = response.json()
-        assert len(questions) == 1
-        assert questions[0]["topic"] == "Math"
-        assert "2+2" in questions[0]["prompt"]
-    
-    @patch('backend.main.verify_token')
-    def test_per_user_deduplication(self, mock_verify_token, client, test_db, sample_questions, test_user):
+    def test_per_user_deduplication(self, authed_client):
         """Test that same user doesn't get duplicate questions."""
-        mock_verify_token.return_value = {"email": "test@example.com", "name": "Test User"}
-        
-        headers = {"Authorization": "Bearer valid_token"}
-        
         # First request - should get questions and create assignments
-        response1 = client.get("/questions?limit=2", headers=headers)
+        response1 = authed_client.get("/questions?limit=2", headers=HEADERS)
         assert response1.status_code == 200
         first_questions = response1.json()
         assert len(first_questions) == 2
         first_ids = [q["id"] for q in first_questions]
         
         # Second request - should get different questions
-        response2 = client.get("/questions?limit=2", headers=headers)
+        response2 = authed_client.get("/questions?limit=2", headers=HEADERS)
         assert response2.status_code == 200
         second_questions = response2.json()
         second_ids = [q["id"] for q in second_questions]
@@ -217,45 +177,37 @@ class TestQuestionsEndpointPhase2:
         assert len(set(first_ids) & set(second_ids)) == 0
         
         # Third request - should return empty (all questions assigned)
-        response3 = client.get("/questions?limit=2", headers=headers)
+        response3 = authed_client.get("/questions?limit=2", headers=HEADERS)
         assert response3.status_code == 200
         third_questions = response3.json()
         assert len(third_questions) == 0
     
-    @patch('backend.main.verify_token')
-    def test_user_not_found(self, mock_verify_token, client, test_db, sample_questions):
+    def test_user_not_found(self, client, auth_as, test_db, sample_questions):
         """Test behavior when authenticated user doesn't exist in database."""
-        mock_verify_token.return_value = {"email": "nonexistent@example.com", "name": "Ghost User"}
+        auth_as({"email": "nonexistent@example.com", "name": "Ghost User"})
         
-        headers = {"Authorization": "Bearer valid_token"}
-        response = client.get("/questions", headers=headers)
+        response = client.get("/questions", headers=HEADERS)
         
         assert response.status_code == 404
         assert "User not found" in response.json()["detail"]
     
-    @patch('backend.main.verify_token')
-    def test_assignment_atomicity(self, mock_verify_token, client, test_db, sample_questions, test_user):
+    def test_assignment_atomicity(self, authed_client, test_db, test_user):
         """Test that question assignments are atomic."""
-        mock_verify_token.return_value = {"email": "test@example.com", "name": "Test User"}
-        
-        headers = {"Authorization": "Bearer valid_token"}
-        
         # Get questions
-        response = client.get("/questions?limit=2", headers=headers)
+        response = authed_client.get("/questions?limit=2", headers=HEADERS)
         assert response.status_code == 200
         questions = response.json()
         assert len(questions) == 2
         
         # Verify assignments were created in database
-        assignments = test_db.query(UserQuestion).filter(
-            UserQuestion.user_id == test_user.id
-        ).all()
-        assert len(assignments) == 2
+        assigned_question_ids = test_db.execute(
+            select(UserQuestion.question_id).where(UserQuestion.user_id == test_user.id)
+        ).scalars().all()
+        assert len(assigned_question_ids) == 2
         
         # Verify assigned questions match returned questions
-        assigned_question_ids = {a.question_id for a in assignments}
         returned_question_ids = {q["id"] for q in questions}
-        assert assigned_question_ids == returned_question_ids
+        assert set(assigned_question_ids) == returned_question_ids
 
 
 class TestImportEndpoint:
@@ -306,20 +258,18 @@ class TestImportEndpoint:
         
         import_data = {"questions": [question_data]}
         
+        count_questions = select(func.count()).select_from(Question)
+        
         # First import
         response1 = client.post("/questions/import", json=import_data)
         assert response1.status_code == 200
-        result1 = response1.json()
-        assert result1["imported_count"] == 1
-        assert result1["skipped_count"] == 0
+        assert test_db.scalar(count_questions) == 1
         
-        # Second import (same question)
+        # Second import (same question) stores nothing new and reports the skip
         response2 = client.post("/questions/import", json=import_data)
         assert response2.status_code == 200
-        result2 = response2.json()
-        assert result2["imported_count"] == 0
-        assert result2["skipped_count"] == 1
-        assert result2["total_questions"] == 1
+        assert test_db.scalar(count_questions) == 1
+        assert response2.json()["skipped_count"] == 1
     
     def test_import_invalid_data(self, client, test_db):
         """Test importing invalid question data."""
@@ -366,17 +316,114 @@ class TestImportEndpoint:
         assert result["skipped_count"] == 1
 
 
+class TestGenerationJobs:
+    """Test POST /generate_questions/ job submission and GET /jobs/{job_id} polling."""
+    
+    setup_payload = {"players": [{"name": "Player1", "age": 8}], "rounds": 1, "topic": "Space"}
+    
+    @patch('backend.main.testing', True)
+    def test_generate_returns_job_then_questions(self, client, auth_as):
+        """Test that generation is queued and its questions are served by the job endpoint."""
+        auth_as({"email": "test@example.com", "name": "Test User"})
+        headers = {"Authorization": "Bearer valid_token"}
+        
+        response = client.post("/generate_questions/", json=self.setup_payload, headers=headers)
+        assert response.status_code == 202
+        job_id = response.json()["job_id"]
+        
+        # TestClient runs background tasks before returning, so the job is already done
+        response = client.get(f"/jobs/{job_id}", params={"wait": 1}, headers=headers)
+        assert response.status_code == 200
+        result = response.json()
+        assert result["status"] == "done"
+        assert len(result["questions"]) > 0
+        assert all(isinstance(q["player_idx"], int) for q in result["questions"])
+    
+    def test_pending_job_returns_202(self, client, auth_as):
+        """Test that polling an unfinished job answers 202 once the wait elapses."""
+        import threading
+        from backend.main import job_storage
+        
+        auth_as({"email": "test@example.com", "name": "Test User"})
+        job_storage["pending-job"] = {
+            "email": "test@example.com",
+            "status": "pending",
+            "questions": [],
+            "changed": threading.Condition(),
+            "created": 0,
+        }
+        try:
+            response = client.get("/jobs/pending-job", headers={"Authorization": "Bearer valid_token"})
+            assert response.status_code == 202
+            assert response.json()["status"] == "pending"
+        finally:
+            job_storage.pop("pending-job", None)
+    
+    @patch('backend.main.testing', True)
+    def test_job_since_returns_only_newer_questions(self, client, auth_as):
+        """Test that `since` skips questions the client already has."""
+        auth_as({"email": "test@example.com", "name": "Test User"})
+        headers = {"Authorization": "Bearer valid_token"}
+        job_id = client.post("/generate_questions/", json=self.setup_payload, headers=headers).json()["job_id"]
+        
+        all_questions = client.get(f"/jobs/{job_id}", headers=headers).json()["questions"]
+        response = client.get(f"/jobs/{job_id}", params={"since": 1}, headers=headers)
+        assert response.status_code == 200
+        assert response.json()["questions"] == all_questions[1:]
+    
+    @patch('backend.main.testing', True)
+    def test_job_is_private_to_its_user(self, client, auth_as):
+        """Test that another user cannot read a job."""
+        auth_as({"email": "test@example.com", "name": "Test User"})
+        response = client.post("/generate_questions/", json=self.setup_payload, headers={"Authorization": "Bearer valid_token"})
+        job_id = response.json()["job_id"]
+        
+        auth_as({"email": "other@example.com", "name": "Other User"})
+        response = client.get(f"/jobs/{job_id}", headers={"Authorization": "Bearer other_token"})
+        assert response.status_code == 404
+    
+    def test_job_response_is_gzipped(self, client, auth_as):
+        """Test that large job payloads are compressed for clients that accept gzip."""
+        import threading
+        from backend.main import job_storage
+        
+        auth_as({"email": "test@example.com", "name": "Test User"})
+        question = {"question": "Which planet is known as the Red Planet?", "options": ["Mars", "Venus", "Jupiter", "Pluto"], "answer": "Mars"}
+        job_storage["large-job"] = {
+            "email": "test@example.com",
+            "status": "done",
+            "questions": [question] * 50,
+            "changed": threading.Condition(),
+            "created": 0,
+        }
+        try:
+            response = client.get(
+                "/jobs/large-job",
+                headers={"Authorization": "Bearer valid_token", "Accept-Encoding": "gzip"}
+            )
+            assert response.status_code == 200
+            assert response.headers["content-encoding"] == "gzip"
+            assert len(response.json()["questions"]) == 50
+        finally:
+            job_storage.pop("large-job", None)
+    
+    def test_generate_unauthenticated(self, client):
+        """Test that job submission requires a token."""
+        response = client.post("/generate_questions/", json=self.setup_payload)
+        assert response.status_code == 401
+
+
 class TestUserStatsEndpoint:
     """Test GET /user_quiz_stats endpoint."""
     
-    def test_user_stats_empty(self, client, test_db):
+    def test_user_stats_empty(self, client, stats_engine):
         """Test user stats with no data."""
         response = client.get("/user_quiz_stats")
         assert response.status_code == 200
         result = response.json()
         assert result["user_quiz_stats"] == []
     
-    def test_user_stats_with_data(self, client, test_db):
+    def test_user_stats_with_data(self, client, stats_engine):
         """Test user stats with trivia log data."""
         # This test would require TriviaLog entries
         # Currently the endpoint queries TriviaLog which requires actual game completion
@@ -389,23 +436,19 @@ class TestUserStatsEndpoint:
 class TestErrorHandling:
     """Test error handling in endpoints."""
     
-    @patch('backend.main.verify_token')
-    def test_database_error_handling(self, mock_verify_token, client, test_user):
+    def test_database_error_handling(self, client, auth_as, tmp_path, monkeypatch):
         """Test that database errors are handled gracefully."""
-        mock_verify_token.return_value = {"email": "test@example.com", "name": "Test User"}
+        auth_as({"email": "test@example.com", "name": "Test User"})
         
-        # Simulate database error by closing the connection
-        headers = {"Authorization": "Bearer valid_token"}
+        # Simulate a database error with sessions on a file SQLite cannot open
+        broken_engine = create_engine(f"sqlite:///{tmp_path / 'missing' / 'trivia.db'}")
+        monkeypatch.setattr("backend.main.SessionLocal", sessionmaker(bind=broken_engine))
         
         # This should handle the database error gracefully
-        with patch('backend.main.SessionLocal') as mock_session:
-            mock_db = MagicMock()
-            mock_db.query.side_effect = Exception("Database connection error")
-            mock_session.return_value = mock_db
-            
-            response = client.get("/questions", headers=headers)
-            assert response.status_code == 500
-            assert "Failed to get questions" in response.json()["detail"]
+        response = client.get("/questions", headers=HEADERS)
+        assert response.status_code == 500
+        assert "Failed to get questions" in response.json()["detail"]
+        broken_engine.dispose()
     
     def test_malformed_authorization_header(self, client):
         """Test malformed authorization headers."""
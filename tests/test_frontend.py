@@ -0,0 +1,72 @@
+import orjson
+import pytest
+import requests
+from pathlib import Path
+from unittest.mock import patch
+from streamlit.testing.v1 import AppTest
+
+APP_PATH = Path(__file__).resolve().parent.parent / "frontend" / "app.py"
+
+
+def job_response(questions, status="pending"):
+    """Build the /jobs/{job_id} response the frontend polls."""
+    response = requests.Response()
+    response.status_code = 200
+    response._content = orjson.dumps({"job_id": "job", "status": status, "questions": questions})
+    return response
+
+
+def question(i):
+    return {
+        "round": i + 1,
+        "player": "Player1",
+        "player_idx": 0,
+        "question": f"Question {i}?",
+        "options": ["A", "B", "C", "D"],
+        "answer": "A",
+    }
+
+
+@pytest.fixture
+def game_in_progress():
+    """An authenticated session that has played the only question generated so far."""
+    at = AppTest.from_file(str(APP_PATH), default_timeout=10)
+    at.session_state.token = "valid_token"
+    at.session_state.user = {"name": "Test User", "email": "test@example.com"}
+    at.session_state.auth_checked = True
+    at.session_state.job_id = "job"
+    at.session_state.questions = [question(0)]
+    at.session_state.current_index = 1
+    at.session_state.player_names = ["Player1"]
+    at.session_state.scores = [0]
+    return at
+
+
+class TestQuestionPolling:
+    """Test how the game loop pulls later questions from a running job."""
+
+    def test_late_question_is_polled_not_timed_out(self, game_in_progress):
+        """Test that a wait long after the game started still polls the job."""
+        responses = [job_response([]), job_response([question(1)])]
+        with patch.object(requests.Session, "request", side_effect=responses) as request:
+            game_in_progress.run()
+
+        assert request.call_count == 2
+        assert not game_in_progress.toast
+        assert game_in_progress.markdown[0].value == "**Question:** Question 1?"
+
+
+class TestGenerationSubmission:
+    """Test that a game queues exactly one generation job."""
+
+    def test_rerun_reuses_submitted_job(self, game_in_progress):
+        """Test that a rerun while loading polls the held job instead of submitting another."""
+        game_in_progress.session_state.questions = []
+        game_in_progress.session_state.current_index = 0
+        game_in_progress.session_state.quiz_loading = True
+        game_in_progress.session_state.setup = {"players": (("Player1", 8),), "rounds": 1, "topic": "Space"}
+        with patch.object(requests.Session, "request", return_value=job_response([question(0)], "done")) as request:
+            game_in_progress.run()
+
+        assert {call.args[0] for call in request.call_args_list} == {"GET"}
+        assert game_in_progress.session_state.job_id == "job"
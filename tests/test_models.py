@@ -1,19 +1,24 @@
 import pytest
 import json
 from datetime import datetime
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from backend.models import Base, User, TriviaLog, Question, UserQuestion
-from backend.database import SessionLocal
+from sqlalchemy import create_engine, insert, inspect, select, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from backend.migrations import LEGACY_ASSIGNMENT_INDEX, migrate_unique_assignments
+from backend.models import Base, User, TriviaLog, Question, UserQuestion, assigned_to
+from tests.db_utils import numbered_options
+
+
+# JSON for the fixed letter option sets, encoded once rather than per question
+OPTIONS_ABCD = json.dumps(["A", "B", "C", "D"])
+OPTIONS_EFGH = json.dumps(["E", "F", "G", "H"])
+OPTIONS_IJKL = json.dumps(["I", "J", "K", "L"])
 
 
 @pytest.fixture
-def test_db():
-    """Create a test database in memory."""
-    engine = create_engine("sqlite:///:memory:")
-    Base.metadata.create_all(bind=engine)
-    TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-    db = TestingSessionLocal()
+def test_db(db_connection):
+    """Create a session whose commits are rolled back after the test."""
+    db = Session(bind=db_connection, autoflush=False, expire_on_commit=False, join_transaction_mode="create_savepoint")
     yield db
     db.close()
 
@@ -111,30 +116,28 @@ class TestQuestionModel:
     def test_question_hash_unique(self, test_db):
         """Test that question hash must be unique."""
         q1 = Question(
-            prompt="Question 1", options=json.dumps(["A", "B", "C", "D"]),
+            prompt="Question 1", options=OPTIONS_ABCD,
             answer="A", topic="Test", min_age=8, max_age=15, hash="unique123"
         )
-        q2 = Question(
-            prompt="Question 2", options=json.dumps(["E", "F", "G", "H"]),
-            answer="E", topic="Test", min_age=8, max_age=15, hash="unique123"  # Same hash
-        )
-        
         test_db.add(q1)
         test_db.commit()
         
-        test_db.add(q2)
-        with pytest.raises(Exception):  # Should fail due to unique constraint
-            test_db.commit()
+        # The duplicate is expected to abort, so insert it without building an ORM object
+        with pytest.raises(IntegrityError):  # Should fail due to unique constraint
+            test_db.execute(insert(Question).values(
+                prompt="Question 2", options=OPTIONS_EFGH,
+                answer="E", topic="Test", min_age=8, max_age=15, hash="unique123"  # Same hash
+            ))
     
     def test_age_range_filtering(self, test_db):
         """Test age range filtering functionality."""
         # Create questions with different age ranges
         q1 = Question(
-            prompt="Easy question", options=json.dumps(["A", "B", "C", "D"]),
+            prompt="Easy question", options=OPTIONS_ABCD,
             answer="A", topic="Test", min_age=5, max_age=10, hash="easy123"
         )
         q2 = Question(
-            prompt="Hard question", options=json.dumps(["E", "F", "G", "H"]),
+            prompt="Hard question", options=OPTIONS_EFGH,
             answer="E", topic="Test", min_age=15, max_age=20, hash="hard123"
         )
         
@@ -164,7 +167,7 @@ class TestUserQuestionModel:
         # Create test data
         user = User(email="assign@example.com", name="Assign User", picture="pic.jpg")
         question = Question(
-            prompt="Test?", options=json.dumps(["A", "B", "C", "D"]),
+            prompt="Test?", options=OPTIONS_ABCD,
             answer="A", topic="Test", min_age=8, max_age=15, hash="assign123"
         )
         test_db.add_all([user, question])
@@ -194,15 +197,15 @@ class TestUserQuestionModel:
         # Create test data
         user = User(email="dedup@example.com", name="Dedup User", picture="pic.jpg")
         q1 = Question(
-            prompt="Q1", options=json.dumps(["A", "B", "C", "D"]),
+            prompt="Q1", options=OPTIONS_ABCD,
             answer="A", topic="Test", min_age=8, max_age=15, hash="dedup1"
         )
         q2 = Question(
-            prompt="Q2", options=json.dumps(["E", "F", "G", "H"]),
+            prompt="Q2", options=OPTIONS_EFGH,
             answer="E", topic="Test", min_age=8, max_age=15, hash="dedup2"
         )
         q3 = Question(
-            prompt="Q3", options=json.dumps(["I", "J", "K", "L"]),
+            prompt="Q3", options=OPTIONS_IJKL,
             answer="I", topic="Test", min_age=8, max_age=15, hash="dedup3"
         )
         
@@ -215,13 +218,7 @@ class TestUserQuestionModel:
         test_db.commit()
         
         # Query for questions NOT already assigned to this user
-        already_assigned = test_db.query(UserQuestion.question_id).filter(
-            UserQuestion.user_id == user.id
-        ).subquery()
-        
-        available_questions = test_db.query(Question).filter(
-            ~Question.id.in_(test_db.query(already_assigned.c.question_id))
-        ).all()
+        available_questions = test_db.query(Question).filter(~assigned_to(user.id)).all()
         
         # Should return q2 and q3, but not q1
         assert len(available_questions) == 2
@@ -235,7 +232,7 @@ class TestUserQuestionModel:
         # Create test data
         user = User(email="perf@example.com", name="Perf User", picture="pic.jpg")
         question = Question(
-            prompt="Performance test", options=json.dumps(["A", "B", "C", "D"]),
+            prompt="Performance test", options=OPTIONS_ABCD,
             answer="A", topic="Test", min_age=8, max_age=15, hash="perf123"
         )
         test_db.add_all([user, question])
@@ -261,40 +258,33 @@ class TestModelIntegration:
         """Test complete workflow: user -> questions -> assignments -> deduplication."""
         # Create user and questions
         user = User(email="workflow@example.com", name="Workflow User", picture="pic.jpg")
-        questions = []
-        for i in range(3):
-            q = Question(
-                prompt=f"Question {i+1}?",
-                options=json.dumps([f"A{i}", f"B{i}", f"C{i}", f"D{i}"]),
-                answer=f"A{i}",
-                topic="Workflow",
-                min_age=8,
-                max_age=15,
-                hash=f"workflow{i}"
-            )
-            questions.append(q)
-        
-        test_db.add_all([user] + questions)
+        test_db.add(user)
+        test_db.execute(insert(Question), [
+            {
+                "prompt": f"Question {i+1}?",
+                "options": numbered_options(i),
+                "answer": f"A{i}",
+                "topic": "Workflow",
+                "min_age": 8,
+                "max_age": 15,
+                "hash": f"workflow{i}"
+            }
+            for i in range(3)
+        ])
         test_db.commit()
         
         # Phase 1: Get all questions (no deduplication)
-        all_questions = test_db.query(Question).all()
-        assert len(all_questions) == 3
+        question_ids = test_db.scalars(select(Question.id).order_by(Question.id)).all()
+        assert len(question_ids) == 3
         
         # Phase 2: Assign first 2 questions to user
-        for q in questions[:2]:
-            assignment = UserQuestion(user_id=user.id, question_id=q.id)
-            test_db.add(assignment)
+        test_db.execute(insert(UserQuestion), [
+            {"user_id": user.id, "question_id": question_id} for question_id in question_ids[:2]
+        ])
         test_db.commit()
         
         # Phase 2: Get remaining questions (with deduplication)
-        already_assigned = test_db.query(UserQuestion.question_id).filter(
-            UserQuestion.user_id == user.id
-        ).subquery()
-        
-        remaining_questions = test_db.query(Question).filter(
-            ~Question.id.in_(test_db.query(already_assigned.c.question_id))
-        ).all()
+        remaining_questions = test_db.query(Question).filter(~assigned_to(user.id)).all()
         
         assert len(remaining_questions) == 1
         assert remaining_questions[0].prompt == "Question 3?"
@@ -303,4 +293,36 @@ class TestModelIntegration:
         user_assignments = test_db.query(UserQuestion).filter(
             UserQuestion.user_id == user.id
         ).count()
-        assert user_assignments == 2
\ No newline at end of file
+        assert user_assignments == 2
+
+
+class TestUniqueAssignmentMigration:
+    """Test upgrading a database created with the old non-unique assignment index."""
+    
+    def test_migration_removes_duplicates_and_replaces_index(self, tmp_path):
+        """Test that the migration keeps one row per pair and swaps the indexes."""
+        engine = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+        Base.metadata.create_all(bind=engine)
+        with engine.begin() as conn:
+            # Recreate the pre-migration schema and a duplicated assignment
+            conn.execute(text("DROP INDEX ux_user_question_assignment"))
+            conn.execute(text(f"CREATE INDEX {LEGACY_ASSIGNMENT_INDEX} ON user_questions (user_id, question_id)"))
+            conn.execute(insert(UserQuestion), [
+                {"user_id": 1, "question_id": 1},
+                {"user_id": 1, "question_id": 1},
+                {"user_id": 1, "question_id": 2},
+            ])
+        
+        assert migrate_unique_assignments(engine) is True
+        
+        with engine.connect() as conn:
+            indexes = {index["name"]: index for index in inspect(conn).get_indexes("user_questions")}
+            pairs = conn.execute(select(UserQuestion.id, UserQuestion.question_id).order_by(UserQuestion.id)).all()
+        assert LEGACY_ASSIGNMENT_INDEX not in indexes
+        assert indexes["ux_user_question_assignment"]["unique"]
+        # The earliest row of the duplicated pair is the one kept
+        assert pairs == [(1, 1), (3, 2)]
+        
+        # Running it again is a no-op
+        assert migrate_unique_assignments(engine) is False
+        engine.dispose()